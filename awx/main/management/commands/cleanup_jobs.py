@@ -4,17 +4,21 @@
 # Python
 import datetime
 import logging
-from optparse import make_option
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Django
-from django.core.management.base import NoArgsCommand, CommandError
-from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Q
 from django.utils.timezone import now
 
 # AWX
 from awx.main.models import (
     Job, AdHocCommand, ProjectUpdate, InventoryUpdate,
-    SystemJob, WorkflowJob, Notification
+    SystemJob, WorkflowJob, Notification,
+    JobEvent, JobHostSummary, AdHocCommandEvent,
+    Project, InventorySource
 )
 from awx.main.signals import ( # noqa
     emit_update_inventory_on_created_or_deleted,
@@ -24,156 +28,203 @@ from awx.main.signals import ( # noqa
 )
 from django.db.models.signals import post_save, post_delete, m2m_changed # noqa
 
+ACTIVE_JOB_STATES = frozenset(('pending', 'waiting', 'running'))
+ACTIVE_NOTIFICATION_STATES = frozenset(('pending',))
 
-class Command(NoArgsCommand):
+# High-volume child tables deleted directly for each batch of parents, so the
+# parent delete does not have to collect them row by row, as
+# (model, parent lookup, raw).  Raw deletes skip signals and the collector
+# entirely, so they are only used for event rows, which have no delete signal
+# handlers and whose only dependents (the job event hosts M2M rows and child
+# events of the same job) are removed in the same batch.
+LEAF_CHILD_MODELS = {
+    Job: (
+        (JobEvent.hosts.through, 'jobevent__job', True),
+        (JobEvent, 'job', True),
+        (JobHostSummary, 'job', False),
+    ),
+    AdHocCommand: (
+        (AdHocCommandEvent, 'ad_hoc_command', True),
+    ),
+}
+
+# Columns needed to render unicode(unified_job) in the debug listings; large
+# text fields such as result_stdout_text and job_env are never fetched.
+UNIFIED_JOB_DISPLAY_FIELDS = ('id', 'polymorphic_ctype', 'created', 'status')
+
+
+def protected_update_q(template_qs):
+    '''
+    Q matching the current and last update of every template in template_qs,
+    built from a single query over the templates.
+    '''
+    protected_pks = set()
+    for current_pk, last_pk in template_qs.values_list('current_job', 'last_job'):
+        protected_pks.add(current_pk)
+        protected_pks.add(last_pk)
+    protected_pks.discard(None)
+    if not protected_pks:
+        return None
+    return Q(pk__in=protected_pks)
+
+
+def project_update_skip_q():
+    # Keep the current and last update of SCM projects.
+    return protected_update_q(Project.objects.exclude(scm_type=''))
+
+
+def inventory_update_skip_q():
+    # Keep the current and last update of each configured inventory source.
+    return protected_update_q(InventorySource.objects.exclude(source=''))
+
+
+def job_displays(qs):
+    qs = qs.only(*UNIFIED_JOB_DISPLAY_FIELDS)
+    # Two correlated subqueries rather than two Count() annotations, which
+    # would join both child tables and build events x host summaries rows.
+    qs = qs.extra(select={
+        'hs_count': 'SELECT COUNT(*) FROM main_jobhostsummary '
+                    'WHERE main_jobhostsummary.job_id = main_job.unifiedjob_ptr_id',
+        'ev_count': 'SELECT COUNT(*) FROM main_jobevent '
+                    'WHERE main_jobevent.job_id = main_job.unifiedjob_ptr_id',
+    })
+    for job in qs.iterator():
+        yield u'"%s" (%d host summaries, %d events)', (job, job.hs_count, job.ev_count)
+
+
+def ad_hoc_command_displays(qs):
+    qs = qs.only(*UNIFIED_JOB_DISPLAY_FIELDS)
+    qs = qs.annotate(ev_count=Count('ad_hoc_command_events'))
+    for ad_hoc_command in qs.iterator():
+        yield u'"%s" (%d events)', (ad_hoc_command, ad_hoc_command.ev_count)
+
+
+def project_update_displays(qs):
+    for pu in qs.only('launch_type', *UNIFIED_JOB_DISPLAY_FIELDS).iterator():
+        yield u'"%s" (type %s)', (pu, pu.launch_type)
+
+
+def inventory_update_displays(qs):
+    for iu in qs.only('source', *UNIFIED_JOB_DISPLAY_FIELDS).iterator():
+        yield u'"%s" (source %s)', (iu, iu.source)
+
+
+def system_job_displays(qs):
+    for sj in qs.only('job_type', *UNIFIED_JOB_DISPLAY_FIELDS).iterator():
+        yield u'"%s" (type %s)', (sj, sj.job_type)
+
+
+def workflow_job_displays(qs):
+    qs = qs.only(*UNIFIED_JOB_DISPLAY_FIELDS)
+    qs = qs.annotate(node_count=Count('workflow_job_nodes'))
+    for workflow_job in qs.iterator():
+        yield u'"%s" (%s nodes)', (workflow_job, workflow_job.node_count)
+
+
+def notification_displays(qs):
+    qs = qs.only('id', 'created', 'notification_type', 'notifications_sent')
+    for notification in qs.iterator():
+        yield u'"%s" (started %s, %s type, %s sent)', (
+            notification, notification.created, notification.notification_type,
+            notification.notifications_sent)
+
+
+# name -> (model, active statuses, extra skip Q function, display function)
+# Display functions yield (format, args) pairs for the debug listings.
+CLEANUP_SPECS = OrderedDict([
+    ('jobs', (Job, ACTIVE_JOB_STATES, None, job_displays)),
+    ('ad_hoc_commands', (AdHocCommand, ACTIVE_JOB_STATES, None, ad_hoc_command_displays)),
+    ('project_updates', (ProjectUpdate, ACTIVE_JOB_STATES, project_update_skip_q, project_update_displays)),
+    ('inventory_updates', (InventoryUpdate, ACTIVE_JOB_STATES, inventory_update_skip_q, inventory_update_displays)),
+    ('management_jobs', (SystemJob, ACTIVE_JOB_STATES, None, system_job_displays)),
+    ('workflow_jobs', (WorkflowJob, ACTIVE_JOB_STATES, None, workflow_job_displays)),
+    ('notifications', (Notification, ACTIVE_NOTIFICATION_STATES, None, notification_displays)),
+])
+
+
+class Command(BaseCommand):
     '''
     Management command to cleanup old jobs and project updates.
     '''
 
     help = 'Remove old jobs, project and inventory updates from the database.'
 
-    option_list = NoArgsCommand.option_list + (
-        make_option('--days', dest='days', type='int', default=90, metavar='N',
-                    help='Remove jobs/updates executed more than N days ago. Defaults to 90.'),
-        make_option('--dry-run', dest='dry_run', action='store_true',
-                    default=False, help='Dry run mode (show items that would '
-                    'be removed)'),
-        make_option('--jobs', dest='only_jobs', action='store_true',
-                    default=False,
-                    help='Remove jobs'),
-        make_option('--ad-hoc-commands', dest='only_ad_hoc_commands',
-                    action='store_true', default=False,
-                    help='Remove ad hoc commands'),
-        make_option('--project-updates', dest='only_project_updates',
-                    action='store_true', default=False,
-                    help='Remove project updates'),
-        make_option('--inventory-updates', dest='only_inventory_updates',
-                    action='store_true', default=False,
-                    help='Remove inventory updates'),
-        make_option('--management-jobs', default=False,
-                    action='store_true', dest='only_management_jobs',
-                    help='Remove management jobs'),
-        make_option('--notifications', dest='only_notifications',
-                    action='store_true', default=False,
-                    help='Remove notifications'),
-        make_option('--workflow-jobs', default=False,
-                    action='store_true', dest='only_workflow_jobs',
-                    help='Remove workflow jobs')
-    )
-
-    def cleanup_jobs(self):
-        #jobs_qs = Job.objects.exclude(status__in=('pending', 'running'))
-        #jobs_qs = jobs_qs.filter(created__lte=self.cutoff)
-        skipped, deleted = 0, 0
-        for job in Job.objects.all():
-            job_display = '"%s" (%d host summaries, %d events)' % \
-                          (unicode(job),
-                           job.job_host_summaries.count(), job.job_events.count())
-            if job.status in ('pending', 'waiting', 'running'):
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s job %s', action_text, job.status, job_display)
-                skipped += 1
-            elif job.created >= self.cutoff:
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s', action_text, job_display)
-                skipped += 1
-            else:
-                action_text = 'would delete' if self.dry_run else 'deleting'
-                self.logger.info('%s %s', action_text, job_display)
-                if not self.dry_run:
-                    job.delete()
-                deleted += 1
-        return skipped, deleted
-
-    def cleanup_ad_hoc_commands(self):
-        skipped, deleted = 0, 0
-        for ad_hoc_command in AdHocCommand.objects.all():
-            ad_hoc_command_display = '"%s" (%d events)' % \
-                (unicode(ad_hoc_command),
-                 ad_hoc_command.ad_hoc_command_events.count())
-            if ad_hoc_command.status in ('pending', 'waiting', 'running'):
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s ad hoc command %s', action_text, ad_hoc_command.status, ad_hoc_command_display)
-                skipped += 1
-            elif ad_hoc_command.created >= self.cutoff:
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s', action_text, ad_hoc_command_display)
-                skipped += 1
-            else:
-                action_text = 'would delete' if self.dry_run else 'deleting'
-                self.logger.info('%s %s', action_text, ad_hoc_command_display)
-                if not self.dry_run:
-                    ad_hoc_command.delete()
-                deleted += 1
-        return skipped, deleted
+    def add_arguments(self, parser):
+        parser.add_argument('--days', dest='days', type=int, default=90, metavar='N',
+                            help='Remove jobs/updates executed more than N days ago. Defaults to 90.')
+        parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                            default=False, help='Dry run mode (count items that would '
+                            'be removed; list them with -v 2)')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=10000,
+                            metavar='N', help='Delete at most N rows per transaction. '
+                            'Defaults to 10000.')
+        parser.add_argument('--workers', dest='workers', type=int, default=1,
+                            metavar='N', help='Clean up to N models concurrently, each '
+                            'in its own thread and database connection. The models '
+                            'share tables, so concurrent deletes may contend for '
+                            'locks. Defaults to 1.')
+        for name in CLEANUP_SPECS:
+            parser.add_argument('--%s' % name.replace('_', '-'), dest='only_%s' % name,
+                                action='store_true', default=False,
+                                help='Remove %s' % name.replace('_', ' '))
 
-    def cleanup_project_updates(self):
-        skipped, deleted = 0, 0
-        for pu in ProjectUpdate.objects.all():
-            pu_display = '"%s" (type %s)' % (unicode(pu), unicode(pu.launch_type))
-            if pu.status in ('pending', 'waiting', 'running'):
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s project update %s', action_text, pu.status, pu_display)
-                skipped += 1
-            elif pu in (pu.project.current_update, pu.project.last_update) and pu.project.scm_type:
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s', action_text, pu_display)
-                skipped += 1
-            elif pu.created >= self.cutoff:
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s', action_text, pu_display)
-                skipped += 1
-            else:
-                action_text = 'would delete' if self.dry_run else 'deleting'
-                self.logger.info('%s %s', action_text, pu_display)
-                if not self.dry_run:
-                    pu.delete()
-                deleted += 1
-        return skipped, deleted
+    def delete_in_batches(self, qs):
+        # Each batch commits in its own transaction; if the command dies part
+        # way through, batches already reported below stay deleted.
+        model = qs.model
+        total = 0
+        while True:
+            pks = list(qs.values_list('pk', flat=True)[:self.batch_size])
+            if not pks:
+                break
+            with transaction.atomic():
+                for child_model, lookup, raw in LEAF_CHILD_MODELS.get(model, ()):
+                    child_qs = child_model.objects.filter(**{'%s__in' % lookup: pks})
+                    if raw:
+                        child_qs._raw_delete(child_qs.db)
+                    else:
+                        child_qs.delete()
+                model.objects.filter(pk__in=pks).delete()
+            total += len(pks)
+            self.logger.info('deleted %d %s (%d so far)', len(pks),
+                             model._meta.verbose_name_plural, total)
 
-    def cleanup_inventory_updates(self):
-        skipped, deleted = 0, 0
-        for iu in InventoryUpdate.objects.all():
-            iu_display = '"%s" (source %s)' % (unicode(iu), unicode(iu.source))
-            if iu.status in ('pending', 'waiting', 'running'):
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s inventory update %s', action_text, iu.status, iu_display)
-                skipped += 1
-            elif iu in (iu.inventory_source.current_update, iu.inventory_source.last_update) and iu.inventory_source.source:
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s', action_text, iu_display)
-                skipped += 1
-            elif iu.created >= self.cutoff:
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s', action_text, iu_display)
-                skipped += 1
-            else:
-                action_text = 'would delete' if self.dry_run else 'deleting'
-                self.logger.info('%s %s', action_text, iu_display)
-                if not self.dry_run:
-                    iu.delete()
-                deleted += 1
+    def _cleanup(self, model, active_states, extra_skip_q_fn=None, display_fn=None):
+        dry_run = self.dry_run
+        cutoff = self.cutoff
+        debug_on = self.logger.isEnabledFor(logging.DEBUG) and display_fn is not None
+        log_debug = self.logger.debug
+        skip_text = 'would skip' if dry_run else 'skipping'
+        delete_text = 'would delete' if dry_run else 'deleting'
+        inactive_qs = model.objects.exclude(status__in=active_states)
+        skip_q = Q(created__gte=cutoff)
+        extra_skip_q = extra_skip_q_fn() if extra_skip_q_fn is not None else None
+        if extra_skip_q is not None:
+            skip_q |= extra_skip_q
+            if debug_on:
+                protected_qs = inactive_qs.filter(created__lt=cutoff).filter(extra_skip_q)
+                for fmt, args in display_fn(protected_qs):
+                    log_debug(u'%s ' + fmt, skip_text, *args)
+        active_skipped = model.objects.filter(status__in=active_states).count()
+        inactive_skipped = inactive_qs.filter(skip_q).count()
+        skipped = active_skipped + inactive_skipped
+        qs = inactive_qs.exclude(skip_q)
+        deleted = qs.count()
+        if debug_on:
+            for fmt, args in display_fn(qs):
+                log_debug(u'%s ' + fmt, delete_text, *args)
+        if not dry_run:
+            self.delete_in_batches(qs)
         return skipped, deleted
 
-    def cleanup_management_jobs(self):
-        skipped, deleted = 0, 0
-        for sj in SystemJob.objects.all():
-            sj_display = '"%s" (type %s)' % (unicode(sj), unicode(sj.job_type))
-            if sj.status in ('pending', 'waiting', 'running'):
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s system_job %s', action_text, sj.status, sj_display)
-                skipped += 1
-            elif sj.created >= self.cutoff:
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s', action_text, sj_display)
-                skipped += 1
-            else:
-                action_text = 'would delete' if self.dry_run else 'deleting'
-                self.logger.info('%s %s', action_text, sj_display)
-                if not self.dry_run:
-                    sj.delete()
-                deleted += 1
-        return skipped, deleted
+    def _cleanup_in_thread(self, spec):
+        # The activity stream switch is thread local, and each worker thread
+        # opens its own database connection which must not be leaked.
+        try:
+            with disable_activity_stream():
+                return self._cleanup(*spec)
+        finally:
+            connection.close()
 
     def init_logging(self):
         log_levels = dict(enumerate([logging.ERROR, logging.INFO,
@@ -185,73 +236,38 @@ class Command(NoArgsCommand):
         self.logger.addHandler(handler)
         self.logger.propagate = False
 
-    def cleanup_workflow_jobs(self):
-        skipped, deleted = 0, 0
-        for workflow_job in WorkflowJob.objects.all():
-            workflow_job_display = '"{}" ({} nodes)'.format(
-                unicode(workflow_job),
-                workflow_job.workflow_nodes.count())
-            if workflow_job.status in ('pending', 'waiting', 'running'):
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s job %s', action_text, workflow_job.status, workflow_job_display)
-                skipped += 1
-            elif workflow_job.created >= self.cutoff:
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s', action_text, workflow_job_display)
-                skipped += 1
-            else:
-                action_text = 'would delete' if self.dry_run else 'deleting'
-                self.logger.info('%s %s', action_text, workflow_job_display)
-                if not self.dry_run:
-                    workflow_job.delete()
-                deleted += 1
-        return skipped, deleted
-
-    def cleanup_notifications(self):
-        skipped, deleted = 0, 0
-        for notification in Notification.objects.all():
-            notification_display = '"{}" (started {}, {} type, {} sent)'.format(
-                unicode(notification), unicode(notification.created),
-                notification.notification_type, notification.notifications_sent)
-            if notification.status in ('pending',):
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s notification %s', action_text, notification.status, notification_display)
-                skipped += 1
-            elif notification.created >= self.cutoff:
-                action_text = 'would skip' if self.dry_run else 'skipping'
-                self.logger.debug('%s %s', action_text, notification_display)
-                skipped += 1
-            else:
-                action_text = 'would delete' if self.dry_run else 'deleting'
-                self.logger.info('%s %s', action_text, notification_display)
-                if not self.dry_run:
-                    notification.delete()
-                deleted += 1
-        return skipped, deleted
-
-    @transaction.atomic
-    def handle_noargs(self, **options):
+    def handle(self, *args, **options):
         self.verbosity = int(options.get('verbosity', 1))
         self.init_logging()
         self.days = int(options.get('days', 90))
         self.dry_run = bool(options.get('dry_run', False))
+        self.batch_size = int(options.get('batch_size', 10000))
+        if self.batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer.')
+        self.workers = int(options.get('workers', 1))
+        if self.workers < 1:
+            raise CommandError('--workers must be a positive integer.')
         try:
             self.cutoff = now() - datetime.timedelta(days=self.days)
         except OverflowError:
             raise CommandError('--days specified is too large. Try something less than 99999 (about 270 years).')
-        model_names = ('jobs', 'ad_hoc_commands', 'project_updates', 'inventory_updates',
-                       'management_jobs', 'workflow_jobs', 'notifications')
         models_to_cleanup = set()
-        for m in model_names:
+        for m in CLEANUP_SPECS:
             if options.get('only_%s' % m, False):
                 models_to_cleanup.add(m)
         if not models_to_cleanup:
-            models_to_cleanup.update(model_names)
-        with disable_activity_stream(), disable_computed_fields():
-            for m in model_names:
-                if m in models_to_cleanup:
-                    skipped, deleted = getattr(self, 'cleanup_%s' % m)()
-                    if self.dry_run:
-                        self.logger.log(99, '%s: %d would be deleted, %d would be skipped.', m.replace('_', ' '), deleted, skipped)
-                    else:
-                        self.logger.log(99, '%s: %d deleted, %d skipped.', m.replace('_', ' '), deleted, skipped)
+            models_to_cleanup.update(CLEANUP_SPECS)
+        specs = [(m, spec) for m, spec in CLEANUP_SPECS.items() if m in models_to_cleanup]
+        with disable_computed_fields():
+            if self.workers > 1 and len(specs) > 1:
+                with ThreadPoolExecutor(max_workers=min(self.workers, len(specs))) as executor:
+                    futures = [(m, executor.submit(self._cleanup_in_thread, spec)) for m, spec in specs]
+                results = [(m, future.result()) for m, future in futures]
+            else:
+                with disable_activity_stream():
+                    results = [(m, self._cleanup(*spec)) for m, spec in specs]
+        for m, (skipped, deleted) in results:
+            if self.dry_run:
+                self.logger.log(99, '%s: %d would be deleted, %d would be skipped.', m.replace('_', ' '), deleted, skipped)
+            else:
+                self.logger.log(99, '%s: %d deleted, %d skipped.', m.replace('_', ' '), deleted, skipped)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# Django
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_v320_drop_v1_credential_fields'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='unifiedjob',
+            index_together=set([('status', 'created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='notification',
+            index_together=set([('status', 'created')]),
+        ),
+    ]
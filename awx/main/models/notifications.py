@@ -143,6 +143,9 @@ class Notification(CreatedModifiedModel):
     class Meta:
         app_label = 'main'
         ordering = ('pk',)
+        index_together = [
+            ('status', 'created'),
+        ]
 
     notification_template = models.ForeignKey(
         'NotificationTemplate',
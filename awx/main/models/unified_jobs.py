@@ -442,6 +442,9 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
 
     class Meta:
         app_label = 'main'
+        index_together = [
+            ('status', 'created'),
+        ]
 
     old_pk = models.PositiveIntegerField(
         null=True,
@@ -0,0 +1,252 @@
+# Python
+import logging
+import pytest
+from datetime import timedelta
+
+# Django
+from django.core.management import call_command
+from django.utils.timezone import now
+
+# AWX
+from awx.main.models import (
+    Job, JobEvent, JobHostSummary, AdHocCommandEvent, Host, Notification,
+    Project, ProjectUpdate, InventorySource, InventoryUpdate
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_cleanup_jobs_logger(request):
+    # Each run adds a StreamHandler bound to the sys.stderr of that moment;
+    # drop them so later tests do not write to a stale capture stream.
+    def fin():
+        logging.getLogger('awx.main.commands.cleanup_jobs').handlers = []
+    request.addfinalizer(fin)
+
+
+def _age(obj, days):
+    type(obj).objects.filter(pk=obj.pk).update(created=now() - timedelta(days=days))
+
+
+def _dry_run_lines(capsys, **options):
+    call_command('cleanup_jobs', days=90, dry_run=True, verbosity=2, **options)
+    out, err = capsys.readouterr()
+    return err.splitlines()
+
+
+def _line_for(lines, action, suffix):
+    return [line for line in lines if line.startswith(action) and line.endswith(suffix)]
+
+
+@pytest.mark.django_db
+def test_cleanup_jobs_deletes_only_old_finished_jobs(job_factory):
+    old_finished = job_factory(initial_state='successful')
+    old_running = job_factory(initial_state='running')
+    recent_finished = job_factory(initial_state='failed')
+    _age(old_finished, 100)
+    _age(old_running, 100)
+    _age(recent_finished, 10)
+
+    call_command('cleanup_jobs', days=90, only_jobs=True, verbosity=0)
+
+    remaining = set(Job.objects.values_list('pk', flat=True))
+    assert remaining == set([old_running.pk, recent_finished.pk])
+
+
+@pytest.mark.django_db
+def test_cleanup_jobs_dry_run_deletes_nothing(job_factory):
+    for i in range(3):
+        _age(job_factory(initial_state='successful'), 100)
+
+    call_command('cleanup_jobs', days=90, only_jobs=True, dry_run=True, verbosity=0)
+
+    assert Job.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_cleanup_jobs_deletes_in_batches(job_factory):
+    for i in range(5):
+        _age(job_factory(initial_state='successful'), 100)
+
+    call_command('cleanup_jobs', days=90, only_jobs=True, batch_size=2, verbosity=0)
+
+    assert Job.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_cleanup_jobs_deletes_children_of_deleted_jobs_only(job_factory):
+    old_finished = job_factory(initial_state='successful')
+    old_running = job_factory(initial_state='running')
+    recent_finished = job_factory(initial_state='failed')
+    for job in (old_finished, old_running, recent_finished):
+        JobEvent.objects.create(job=job, event='runner_on_ok')
+        JobHostSummary.objects.create(job=job, host_name='host-1')
+    _age(old_finished, 100)
+    _age(old_running, 100)
+    _age(recent_finished, 10)
+
+    call_command('cleanup_jobs', days=90, only_jobs=True, batch_size=1, verbosity=0)
+
+    kept = set([old_running.pk, recent_finished.pk])
+    assert set(JobEvent.objects.values_list('job_id', flat=True)) == kept
+    assert set(JobHostSummary.objects.values_list('job_id', flat=True)) == kept
+
+
+@pytest.mark.django_db
+def test_cleanup_jobs_raw_deletes_job_event_tree(job_factory, host):
+    old_job = job_factory(initial_state='successful')
+    recent_job = job_factory(initial_state='successful')
+    for job in (old_job, recent_job):
+        parent = JobEvent.objects.create(job=job, event='playbook_on_task_start')
+        child = JobEvent.objects.create(job=job, event='runner_on_ok', parent=parent, host=host)
+        parent.hosts.add(host)
+        child.hosts.add(host)
+    JobHostSummary.objects.create(job=old_job, host=host)
+    host = Host.objects.get(pk=host.pk)
+    assert host.last_job_id == old_job.pk
+    assert host.last_job_host_summary_id is not None
+    _age(old_job, 100)
+    _age(recent_job, 10)
+
+    call_command('cleanup_jobs', days=90, only_jobs=True, verbosity=0)
+
+    assert not Job.objects.filter(pk=old_job.pk).exists()
+    assert not JobEvent.objects.filter(job_id=old_job.pk).exists()
+    assert not JobEvent.hosts.through.objects.filter(jobevent__job_id=old_job.pk).exists()
+    assert not JobHostSummary.objects.filter(job_id=old_job.pk).exists()
+    host = Host.objects.get(pk=host.pk)
+    assert host.last_job_id is None
+    assert host.last_job_host_summary_id is None
+    assert JobEvent.objects.filter(job=recent_job).count() == 2
+    assert JobEvent.objects.filter(job=recent_job, parent__isnull=False).count() == 1
+    assert JobEvent.hosts.through.objects.filter(jobevent__job=recent_job).count() == 2
+
+
+@pytest.mark.django_db
+def test_cleanup_ad_hoc_commands_raw_deletes_events(ad_hoc_command_factory, host):
+    old_command = ad_hoc_command_factory(initial_state='successful')
+    recent_command = ad_hoc_command_factory(initial_state='successful')
+    for ad_hoc_command in (old_command, recent_command):
+        AdHocCommandEvent.objects.create(ad_hoc_command=ad_hoc_command, event='runner_on_ok', host=host)
+    _age(old_command, 100)
+    _age(recent_command, 10)
+
+    call_command('cleanup_jobs', days=90, only_ad_hoc_commands=True, verbosity=0)
+
+    assert list(AdHocCommandEvent.objects.values_list('ad_hoc_command_id', flat=True)) == [recent_command.pk]
+    assert Host.objects.filter(pk=host.pk).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cleanup_jobs_with_workers(job_factory, notification):
+    old_job = job_factory(initial_state='successful')
+    recent_job = job_factory(initial_state='successful')
+    _age(old_job, 100)
+    _age(recent_job, 10)
+    _age(notification, 100)
+
+    call_command('cleanup_jobs', days=90, only_jobs=True, only_notifications=True,
+                 workers=2, verbosity=0)
+
+    assert list(Job.objects.values_list('pk', flat=True)) == [recent_job.pk]
+    assert not Notification.objects.filter(pk=notification.pk).exists()
+
+
+@pytest.mark.django_db
+def test_cleanup_project_updates_keeps_last_update(project):
+    old_update = ProjectUpdate.objects.create(project=project, status='successful')
+    last_update = ProjectUpdate.objects.create(project=project, status='successful')
+    _age(old_update, 100)
+    _age(last_update, 100)
+    Project.objects.filter(pk=project.pk).update(current_job=None, last_job=last_update)
+
+    call_command('cleanup_jobs', days=90, only_project_updates=True, verbosity=0)
+
+    assert list(ProjectUpdate.objects.values_list('pk', flat=True)) == [last_update.pk]
+
+
+@pytest.mark.django_db
+def test_dry_run_lists_jobs(job_factory, capsys):
+    job = job_factory(initial_state='successful')
+    _age(job, 100)
+
+    lines = _dry_run_lines(capsys, only_jobs=True)
+
+    assert _line_for(lines, 'would delete "', '-%d-successful" (0 host summaries, 0 events)' % job.pk)
+    assert 'jobs: 1 would be deleted, 0 would be skipped.' in lines
+    assert Job.objects.filter(pk=job.pk).exists()
+
+
+@pytest.mark.django_db
+def test_dry_run_lists_ad_hoc_commands(ad_hoc_command_factory, capsys):
+    ad_hoc_command = ad_hoc_command_factory(initial_state='failed')
+    _age(ad_hoc_command, 100)
+
+    lines = _dry_run_lines(capsys, only_ad_hoc_commands=True)
+
+    assert _line_for(lines, 'would delete "', '-%d-failed" (0 events)' % ad_hoc_command.pk)
+    assert 'ad hoc commands: 1 would be deleted, 0 would be skipped.' in lines
+
+
+@pytest.mark.django_db
+def test_dry_run_lists_project_updates(project, capsys):
+    old_update = ProjectUpdate.objects.create(project=project, status='successful')
+    last_update = ProjectUpdate.objects.create(project=project, status='successful')
+    _age(old_update, 100)
+    _age(last_update, 100)
+    Project.objects.filter(pk=project.pk).update(current_job=None, last_job=last_update)
+
+    lines = _dry_run_lines(capsys, only_project_updates=True)
+
+    assert _line_for(lines, 'would delete "', '-%d-successful" (type manual)' % old_update.pk)
+    assert _line_for(lines, 'would skip "', '-%d-successful" (type manual)' % last_update.pk)
+    assert 'project updates: 1 would be deleted, 1 would be skipped.' in lines
+
+
+@pytest.mark.django_db
+def test_dry_run_lists_inventory_updates(inventory_source, capsys):
+    old_update = InventoryUpdate.objects.create(inventory_source=inventory_source,
+                                                source='gce', status='successful')
+    last_update = InventoryUpdate.objects.create(inventory_source=inventory_source,
+                                                 source='gce', status='successful')
+    _age(old_update, 100)
+    _age(last_update, 100)
+    InventorySource.objects.filter(pk=inventory_source.pk).update(current_job=None, last_job=last_update)
+
+    lines = _dry_run_lines(capsys, only_inventory_updates=True)
+
+    assert _line_for(lines, 'would delete "', '-%d-successful" (source gce)' % old_update.pk)
+    assert _line_for(lines, 'would skip "', '-%d-successful" (source gce)' % last_update.pk)
+    assert 'inventory updates: 1 would be deleted, 1 would be skipped.' in lines
+
+
+@pytest.mark.django_db
+def test_dry_run_lists_management_jobs(system_job_factory, capsys):
+    system_job = system_job_factory(initial_state='successful')
+    _age(system_job, 100)
+
+    lines = _dry_run_lines(capsys, only_management_jobs=True)
+
+    assert _line_for(lines, 'would delete "', '-%d-successful" (type cleanup_jobs)' % system_job.pk)
+    assert 'management jobs: 1 would be deleted, 0 would be skipped.' in lines
+
+
+@pytest.mark.django_db
+def test_dry_run_lists_workflow_jobs(workflow_job_factory, capsys):
+    workflow_job = workflow_job_factory(initial_state='successful')
+    _age(workflow_job, 100)
+
+    lines = _dry_run_lines(capsys, only_workflow_jobs=True)
+
+    assert _line_for(lines, 'would delete "', '-%d-successful" (0 nodes)' % workflow_job.pk)
+    assert 'workflow jobs: 1 would be deleted, 0 would be skipped.' in lines
+
+
+@pytest.mark.django_db
+def test_dry_run_lists_notifications(notification, capsys):
+    _age(notification, 100)
+
+    lines = _dry_run_lines(capsys, only_notifications=True)
+
+    assert _line_for(lines, 'would delete "notification-%d" (started ' % notification.pk,
+                     ', email type, 1 sent)')
+    assert 'notifications: 1 would be deleted, 0 would be skipped.' in lines